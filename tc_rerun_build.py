@@ -1,15 +1,86 @@
 import argparse
 import xml.etree.ElementTree as ET
 from collections import defaultdict
+import functools
 import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from requests.cookies import RequestsCookieJar
+from requests.structures import CaseInsensitiveDict
 import urllib3
+try:
+    import xmltodict
+except ImportError:
+    xmltodict = None
 import time
-import json
+import random
+import string
+import threading
 import io
+import os
 from urllib.parse import urlparse
+from xml.sax.saxutils import escape, quoteattr
+try:
+    import orjson
+    from orjson import loads as _jloads
+
+    def _jdumps(obj):
+        # Accept non-str dict keys like json.dumps does
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    import json
+    _jloads = json.loads
+
+    def _jdumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+
+# Shared session so consecutive REST calls to the same TeamCity host reuse
+# the pooled keep-alive connection instead of a new TCP+TLS handshake each time.
+# pool_maxsize has to be >= the number of concurrent in-flight calls (~1-2 today),
+# otherwise urllib3 discards returned sockets with "Connection pool is full".
+# Retries are handled in teamcity_rest_call_reuse_session, so the adapter does none.
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=16, max_retries=0))
+_SESSION_AUTH_LOCK = threading.Lock()
+
+# Certificates are verified against TC_CA_BUNDLE (or the default CA bundle).
+# Setting TC_INSECURE=1 opts out of verification, as all calls used to do.
+# _VERIFY is passed explicitly with every request: TC_INSECURE and TC_CA_BUNDLE
+# win over REQUESTS_CA_BUNDLE/CURL_CA_BUNDLE, which only apply when neither is set.
+if os.environ.get('TC_INSECURE', '').lower() in ('1', 'true', 'yes'):
+    _VERIFY = False
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+else:
+    _VERIFY = os.environ.get('TC_CA_BUNDLE', True)
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# ETag and parsed data of the last response per REST URL, used to skip
+# re-downloading and re-parsing unchanged responses while polling
+_ETAG_CACHE = {}
+
+RUNNING_BUILD_FIELDS = "state,buildTypeId,branchName,lastChanges(change(id))"
+
+
+def _get_session_id(response, tcSessionId=None):
+    """
+    Get the TeamCity session ID of a response
+
+    Parameters:
+        response:     response received from server
+        tcSessionId:  cookies sent along with the request
+
+    Returns:
+        sessionId: Session ID to be used in upcoming requests
+    """
+    if tcSessionId:
+        return tcSessionId['TCSESSIONID']
+    return response.cookies.get('TCSESSIONID')
 
 
-def make_rest_call(url=None, postdata=None, request_type=None, tcSessionId=None, headers=None, ConnectionTimeOut=None):
+def make_rest_call(url=None, postdata=None, request_type=None, tcSessionId=None, headers=None, ConnectionTimeOut=None,
+                   out_fileobj=None, response_headers=None):
     """
     This function performs a REST API call and uses Session ID for persistent connection
 
@@ -22,60 +93,64 @@ def make_rest_call(url=None, postdata=None, request_type=None, tcSessionId=None,
         headers: Headers that needs to be attached with the request
         ConnectionTimeOut: Terminates a connection if it takes longer
                             to give a response. (value in seconds)
+        out_fileobj: Binary file object a successful streamed (GETS) response
+                      is written to chunk by chunk instead of being kept in memory
+        response_headers: Dictionary updated with the headers of the response
 
     Returns:
-        rest_data:  This is the data from the REST query
+        rest_data:  This is the data from the REST query, or out_fileobj
+                      when the response was streamed into it
         status_code: exit status of request
         sessionId: Session ID Created during the request so it can be used
                       in upcoming requests
-        response_text: entire response received from server
+        response_text: entire response received from server, as the raw
+                      bytes (not decoded, to avoid charset detection) or as
+                      a file object for streamed responses
     """
+    cookies = None
+    if tcSessionId:
+        cookies = RequestsCookieJar()
+        cookies.update(tcSessionId)
     if request_type == "GET":
-        with requests.get(url, cookies=tcSessionId, timeout=ConnectionTimeOut,
-                          headers=headers, verify=False) as r:
+        with _SESSION.get(url, cookies=cookies, timeout=ConnectionTimeOut,
+                          headers=headers, verify=_VERIFY) as r:
             rest_data = r.content
             status_code = r.status_code
-            if not tcSessionId:
-                try:
-                    sessionId = r.cookies['TCSESSIONID']
-                except:
-                    sessionId = None
-            else:
-                sessionId = tcSessionId['TCSESSIONID']
-            response_text = r.text
-        r.close()
+            sessionId = _get_session_id(r, tcSessionId)
+            if response_headers is not None:
+                response_headers.update(r.headers)
+            response_text = rest_data
     elif request_type == "GETS":
-        with requests.get(url, cookies=tcSessionId, timeout=ConnectionTimeOut,
-                          headers=headers, verify=False, stream=True) as r:
-            rest_data = r.content
+        with _SESSION.get(url, cookies=cookies, timeout=ConnectionTimeOut,
+                          headers=headers, verify=_VERIFY, stream=True) as r:
             status_code = r.status_code
-            if not tcSessionId:
-                try:
-                    sessionId = r.cookies['TCSESSIONID']
-                except:
-                    sessionId = None
+            sessionId = _get_session_id(r, tcSessionId)
+            if response_headers is not None:
+                response_headers.update(r.headers)
+            if out_fileobj is not None and status_code == 200:
+                for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    out_fileobj.write(chunk)
+                rest_data = out_fileobj
+                response_text = out_fileobj
             else:
-                sessionId = tcSessionId['TCSESSIONID']
-            response_text = io.BytesIO(r.content)
-        r.close()
+                response_text = io.BytesIO()
+                for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    response_text.write(chunk)
+                response_text.seek(0)
+                rest_data = response_text.getvalue()
     elif request_type == "POST":
-        with requests.post(url,
-                           cookies=tcSessionId,
+        with _SESSION.post(url,
+                           cookies=cookies,
                            timeout=ConnectionTimeOut,
                            headers=headers,
-                           verify=False,
+                           verify=_VERIFY,
                            data=postdata) as r:
             rest_data = r.content
             status_code = r.status_code
-            if not tcSessionId:
-                try:
-                    sessionId = r.cookies['TCSESSIONID']
-                except:
-                    sessionId = None
-            else:
-                sessionId = tcSessionId['TCSESSIONID']
-            response_text = r.text
-        r.close()
+            sessionId = _get_session_id(r, tcSessionId)
+            if response_headers is not None:
+                response_headers.update(r.headers)
+            response_text = rest_data
     return rest_data, status_code, sessionId, response_text
 
 
@@ -115,18 +190,23 @@ def _etree_to_dict(etree):
 
 
 def initiate_rest_call(url=None, postdata="", datatype="json", tcSessionId=None, ConnectionTimeOut=None,
-                       serverUrl=None, requestType=None):
+                       serverUrl=None, requestType=None, out_fileobj=None, extra_headers=None,
+                       response_headers=None):
     """
     This function identifies headers and request type, and takes care of data classification
 
     Parameters:
         urls:  REST URI for the query
-        postdata:  This is the data to post
+        postdata:  This is the data to post, dict or list for json
+                   are serialized here
         type:      This is the data type to expect (json, xml, text)
         tcSessionId: Providing Session prevents authentication
                       for consecutive sessions
         ConnectionTimeOut: Terminates a connection if it takes longer
                             to give a response. (value in seconds)
+        out_fileobj: Binary file object zip responses are streamed to
+        extra_headers: Additional headers to attach to the request
+        response_headers: Dictionary updated with the headers of the response
 
     Returns:
         rest_data:  This is the data from the REST query
@@ -138,25 +218,31 @@ def initiate_rest_call(url=None, postdata="", datatype="json", tcSessionId=None,
     url = url.replace('/httpAuth/', '/')
     if datatype == 'json':
         headers = {'Content-Type': 'application/json', 'Accept': 'application/json', 'Origin': serverUrl}
+        if isinstance(postdata, (dict, list)):
+            postdata = _jdumps(postdata)
+        headers.update(extra_headers or {})
         if requestType == None:
             requestType = "GET"
         rest_data, status_code, sessionId, response_text = make_rest_call(
             url, postdata, requestType, tcSessionId, headers,
-            ConnectionTimeOut)
+            ConnectionTimeOut, response_headers=response_headers)
         try:
-            rest_data = json.loads(rest_data)
+            rest_data = _jloads(rest_data)
         except:
             rest_data = None
     elif datatype == 'xml':
         headers = {'Content-Type': 'application/xml', 'Accept': 'application/xml', 'Origin': serverUrl}
+        headers.update(extra_headers or {})
         if requestType == None:
             requestType = "POST"
         rest_data, status_code, sessionId, response_text = make_rest_call(
             url, postdata, requestType, tcSessionId, headers,
-            ConnectionTimeOut)
+            ConnectionTimeOut, response_headers=response_headers)
         try:
-            element_tree = ET.XML(rest_data)
-            rest_data = _etree_to_dict(element_tree)
+            if xmltodict:
+                rest_data = xmltodict.parse(rest_data, attr_prefix='', cdata_key='#text')
+            else:
+                rest_data = _etree_to_dict(ET.XML(rest_data))
         except:
             rest_data = None
     elif datatype == 'text':
@@ -165,11 +251,12 @@ def initiate_rest_call(url=None, postdata="", datatype="json", tcSessionId=None,
             'Accept': 'text/plain',
             'Origin': serverUrl
         }
+        headers.update(extra_headers or {})
         if requestType == None:
             requestType = "GET"
         rest_data, status_code, sessionId, response_text = make_rest_call(
             url, postdata, requestType, tcSessionId, headers,
-            ConnectionTimeOut)
+            ConnectionTimeOut, response_headers=response_headers)
         try:
             rest_data = rest_data.decode('utf-8').strip("\n")
         except:
@@ -181,19 +268,55 @@ def initiate_rest_call(url=None, postdata="", datatype="json", tcSessionId=None,
             'Accept': 'application/octet-stream',
             'Origin': serverUrl
         }
+        headers.update(extra_headers or {})
         if requestType == None:
             requestType = "GETS"
         rest_data, status_code, sessionId, response_text = make_rest_call(
             url, postdata, requestType, tcSessionId, headers,
-            ConnectionTimeOut)
+            ConnectionTimeOut, out_fileobj, response_headers)
 
     return rest_data, status_code, sessionId, response_text
 
 
+@functools.lru_cache(maxsize=16)
+def _server_urls(server, rest_uri):
+    """
+    Build the URLs of a REST call, cached as they do not change while polling
+
+    Parameters:
+        server:    Server address (URL)
+        rest_uri:  REST URI for the query
+
+    Returns:
+        rest_url:   REST URL of the query
+        serverUrl:  URL of the server
+    """
+    server = urlparse(server).netloc
+    rest_url = 'https://{0}/{1}'.format(server, rest_uri)
+    serverUrl = 'https://{0}'.format(server)
+    return rest_url, serverUrl
+
+
+def _set_session_auth(user, password):
+    """
+    Attach HTTP Basic auth of the REST user to the shared session, so the
+    credentials never have to be embedded in (and logged with) the URL
+
+    Parameters:
+        user:      REST user, None removes any previously attached auth
+        password:  Password to authenticate user
+    """
+    auth = HTTPBasicAuth(user, password) if user is not None else None
+    with _SESSION_AUTH_LOCK:
+        if _SESSION.auth != auth:
+            _SESSION.auth = auth
+
+
 def teamcity_rest_call_reuse_session(server=None, rest_uri=None, user=None, password=None,
                                      postdata="", datatype="json", debugout=False, tcSessionId=None,
                                      ConnectionTimeOut=180, requestType=None, retry_attempt=10,
-                                     sleep_seconds=30):
+                                     sleep_seconds=5, out_fileobj=None, max_sleep_seconds=60,
+                                     use_etag=False):
     """
     This function gathers data and generates URL required to initiate a REST API Call
     it uses the provided Session ID, and tried to generate a session using that
@@ -212,107 +335,100 @@ def teamcity_rest_call_reuse_session(server=None, rest_uri=None, user=None, pass
                             to give a response. (value in seconds)
         requestType:        Accepted Values are GET or POST
         retry_attempt:      Retry the same request on certain conditions
-        sleep_seconds:      sleep between retires
+        sleep_seconds:      initial sleep between retries, doubled on
+                            every further retry (with jitter)
+        out_fileobj:        Binary file object zip responses are streamed to
+        max_sleep_seconds:  upper bound of the sleep between retries
+        use_etag:           Send If-None-Match with the ETag of the previous
+                            response of this URL and reuse its data on HTTP 304
 
     Returns:
         rest_data:  This is the data from the REST query
         tcSessionId: Session ID Created during the request so it can be used
                       in upcoming requests
     """
-    try:
-        postdata = str(postdata.decode("utf-8")).replace('\n', '').replace('\r', '')
-    except Exception:
-        postdata = postdata
     rest_data = ""
-    orig_server = server
-    serverHost = urlparse(server)
-    server = serverHost.netloc
-    rest_url = 'https://{0}:{1}@{2}/{3}'.format(user, password, server, rest_uri)
-    rest_url_no_pass = 'https://{0}/{1}'.format(server, rest_uri)
-    serverUrl = 'https://{0}'.format(server)
+    rest_url, serverUrl = _server_urls(server, rest_uri)
+    _set_session_auth(user, password)
 
-    try:
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-        if debugout:
-            print("REST request: {}".format(rest_url_no_pass))
-            print("Server: {0}".format(server))
-            print("rest uri: {0}".format(rest_uri))
-            print("user: {0}".format(user))
-            print("postdata: {0}".format(postdata))
-            print("datatype: {0}".format(datatype))
-        if tcSessionId:
-            cookies = {'TCSESSIONID': tcSessionId}
-            rest_data, status_code, tcSessionId, response_text = initiate_rest_call(
-                url=rest_url_no_pass,
-                postdata=postdata,
-                datatype=datatype,
-                tcSessionId=cookies,
-                ConnectionTimeOut=ConnectionTimeOut,
-                serverUrl=serverUrl,
-                requestType=requestType)
+    if debugout:
+        print("REST request: {}".format(rest_url))
+        print("Server: {0}".format(urlparse(server).netloc))
+        print("rest uri: {0}".format(rest_uri))
+        print("user: {0}".format(user))
+        print("postdata: {0}".format(postdata.decode('utf-8', 'replace')
+                                     if isinstance(postdata, bytes) else postdata))
+        print("datatype: {0}".format(datatype))
+    cached = _ETAG_CACHE.get(rest_url) if use_etag else None
+    extra_headers = {'If-None-Match': cached[0]} if cached else None
+
+    def send_request(cookies):
+        # A single REST round-trip, its response is released as soon as the
+        # next attempt overwrites the result
+        response_headers = CaseInsensitiveDict()
+        rest_data, status_code, sessionId, response_text = initiate_rest_call(
+            url=rest_url,
+            postdata=postdata,
+            datatype=datatype,
+            tcSessionId=cookies,
+            ConnectionTimeOut=ConnectionTimeOut,
+            serverUrl=serverUrl,
+            requestType=requestType,
+            out_fileobj=out_fileobj,
+            extra_headers=extra_headers,
+            response_headers=response_headers)
+        return rest_data, status_code, sessionId, response_headers
+
+    for attempt in range(max(retry_attempt, 1)):
+        try:
+            cookies = {'TCSESSIONID': tcSessionId} if tcSessionId else None
+            rest_data, status_code, tcSessionId, response_headers = send_request(cookies)
 
             # If above request failed because the cookie expired or access limitation of cookies
-            # a second attempt will be initiated with username and password
-
-            if status_code == 401 or status_code == 403:
-                print("Using User/Pass because Cookies failed with HTTP {0}".format(status_code))
-                cookies = None
-                rest_data, status_code, tcSessionId, response_text = initiate_rest_call(
-                    url=rest_url,
-                    postdata=postdata,
-                    datatype=datatype,
-                    tcSessionId=cookies,
-                    ConnectionTimeOut=ConnectionTimeOut,
-                    serverUrl=serverUrl,
-                    requestType=requestType)
-        else:
-            cookies = None
-            rest_data, status_code, tcSessionId, response_text = initiate_rest_call(
-                url=rest_url,
-                postdata=postdata,
-                datatype=datatype,
-                tcSessionId=cookies,
-                ConnectionTimeOut=ConnectionTimeOut,
-                serverUrl=serverUrl,
-                requestType=requestType)
-
-        if status_code in [500, 502, 503, 401]:
-            # If rest api call return following error codes, It would use recursion to retry:
-            # HTTP 500 - Internal Server Error
-            # HTTP 502 - Bad Gateway
-            # HTTP 503 - Service Unavailable
-            # HTTP 401 - Unauthorized
-            retry_attempt -= 1
-            print("REST Request Failed with HTTP {0} URL: {1}. Retrying...".format(status_code, rest_url_no_pass))
-            if retry_attempt <= 0:
-                return False, tcSessionId
-            time.sleep(sleep_seconds)
-            rest_data, tcSessionId = teamcity_rest_call_reuse_session(
-                server=orig_server,
-                rest_uri=rest_uri,
-                user=user,
-                password=password,
-                postdata=postdata,
-                datatype=datatype,
-                debugout=debugout,
-                tcSessionId=tcSessionId,
-                ConnectionTimeOut=ConnectionTimeOut,
-                requestType=requestType,
-                retry_attempt=retry_attempt,
-                sleep_seconds=sleep_seconds)
-        elif status_code != 200:
-            print("REST Request Failed with HTTP {0} URL: {1}".format(status_code, rest_url_no_pass))
-            return False, False
-
-    except Exception as e:
-        print("Error: Could not connect to the Teamcity Server, Please try re-running build again later.")
-        print("Exception details: {}".format(e))
-        print("rest_url={}".format(rest_url_no_pass))
+            # a second attempt will be initiated without cookies, relying on the Basic auth
+            # attached to the session
+
+            if cookies and status_code in [401, 403]:
+                print("Dropping Cookies because they failed with HTTP {0}".format(status_code))
+                _SESSION.cookies.clear()
+                rest_data, status_code, tcSessionId, response_headers = send_request(None)
+
+            if status_code in [500, 502, 503, 401]:
+                # If rest api call return following error codes, It would retry with backoff:
+                # HTTP 500 - Internal Server Error
+                # HTTP 502 - Bad Gateway
+                # HTTP 503 - Service Unavailable
+                # HTTP 401 - Unauthorized
+                print("REST Request Failed with HTTP {0} URL: {1}. Retrying...".format(status_code, rest_url))
+                if attempt + 1 >= retry_attempt:
+                    return False, tcSessionId
+                # Exponential backoff with jitter, so a briefly degraded server recovers
+                # quickly while a server that stays down is not hit at a constant cadence
+                delay = min(max_sleep_seconds, sleep_seconds * 2 ** attempt)
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                continue
+            elif status_code not in [200, 304]:
+                print("REST Request Failed with HTTP {0} URL: {1}".format(status_code, rest_url))
+                return False, False
+
+            if status_code == 304 and cached:
+                # HTTP 304 - Not Modified, the previously parsed response is still valid
+                rest_data = cached[1]
+            elif use_etag and response_headers.get('ETag'):
+                _ETAG_CACHE[rest_url] = (response_headers['ETag'], rest_data)
+
+        except Exception as e:
+            print("Error: Could not connect to the Teamcity Server, Please try re-running build again later.")
+            print("Exception details: {}".format(e))
+            print("rest_url={}".format(rest_url))
+            # Do not hand the body of an earlier failed attempt back as data
+            rest_data = ""
+        break
     return rest_data, tcSessionId
 
 
 def get_build_details(project_id, teamcity_url, user, password, isrunning=False, debugout=False,
-                      tcSessionId=None):
+                      tcSessionId=None, long_poll=0):
     """
     Get the details of project_id
 
@@ -322,11 +438,17 @@ def get_build_details(project_id, teamcity_url, user, password, isrunning=False,
         user          The rest user credential
         password      The password for rest user credential
         tcSessionId   reuse existing sessiong for REST API Calls
+        long_poll     seconds the server may hold the request of a running
+                      build until its state changes (0 disables long-polling)
     Return
         build_details
     """
     if isrunning:
-        build_details_rest_uri = "httpAuth/app/rest/builds/id:{}".format(project_id)
+        # Only request the fields needed to poll and re-trigger the build
+        build_details_rest_uri = "httpAuth/app/rest/builds/id:{}?fields={}".format(
+            project_id, RUNNING_BUILD_FIELDS)
+        if long_poll:
+            build_details_rest_uri += "&wait=true&timeout={}".format(long_poll)
     else:
         build_details_rest_uri = "httpAuth/app/rest/buildTypes/id:{}".format(project_id)
     build_details = {}
@@ -337,13 +459,22 @@ def get_build_details(project_id, teamcity_url, user, password, isrunning=False,
             user,
             password,
             debugout=debugout,
-            tcSessionId=tcSessionId)
+            tcSessionId=tcSessionId,
+            ConnectionTimeOut=max(180, long_poll + 15),
+            use_etag=isrunning)
     except Exception as this_exception:
         print("!!! WARNING: {}/{} failed".format(teamcity_url, build_details_rest_uri))
         print(this_exception)
     return build_details, tcSessionId
 
 
+_BUILD_XML_TMPL = string.Template("""<build branchName=$branch>
+  <buildType id=$cfg/>
+$opt_parts  <properties>
+$props  </properties>
+</build>""")
+
+
 def trigger_build_with_changeID(config_id=None, premerge_changes=None,
                                 tc_internal_change_id=None, properties=None,
                                 user=None, password=None, teamcity_url=None,
@@ -373,27 +504,23 @@ def trigger_build_with_changeID(config_id=None, premerge_changes=None,
     """
     premerge_changes = "" if premerge_changes == "<default>" else premerge_changes
     print("------ trigger_project: config_id={} ------".format(config_id))
-    build_id = []
-    build_id.append('<build branchName="{}">'.format(premerge_changes))
-    build_id.append('  <buildType id="{}"/>'.format(config_id))
+    opt_parts = []
     if bump_to_top:
-        build_id.append('  <triggeringOptions queueAtTop="true" />')
+        opt_parts.append('  <triggeringOptions queueAtTop="true" />\n')
     if comment:
-        build_id.append('  <comment><text>{}</text></comment>'.format(comment))
+        opt_parts.append('  <comment><text>{}</text></comment>\n'.format(escape(str(comment))))
     if tc_internal_change_id:
-        build_id.append('    <lastChanges>')
-        build_id.append('    <change id="{}" personal="false" />'
-                        .format(tc_internal_change_id))
-        build_id.append('    </lastChanges>')
-    build_id.append('  <properties>')
-    for prop, value in properties.items():
-        build_id.append('    <property name="{}" value="{}"/>'
-                        .format(prop, value))
-    build_id.append('  </properties>')
-    build_id.append('</build>')
-    build_id_xml = "\n".join(build_id)
+        opt_parts.append('    <lastChanges>\n'
+                         '    <change id={} personal="false" />\n'
+                         '    </lastChanges>\n'.format(quoteattr(str(tc_internal_change_id))))
+    build_id_xml = _BUILD_XML_TMPL.substitute(
+        branch=quoteattr(str(premerge_changes)),
+        cfg=quoteattr(str(config_id)),
+        opt_parts="".join(opt_parts),
+        props="".join('    <property name={} value={}/>\n'.format(quoteattr(str(prop)), quoteattr(str(value)))
+                      for prop, value in properties.items())).encode('utf-8')
     if debugout:
-        print("build_id:\n{}".format(build_id_xml))
+        print("build_id:\n{}".format(build_id_xml.decode('utf-8')))
     triggered_build = ""
     return_value = ""
 
@@ -404,7 +531,7 @@ def trigger_build_with_changeID(config_id=None, premerge_changes=None,
         triggered_build, tcSessionId = teamcity_rest_call_reuse_session(
             server=teamcity_url,
             rest_uri="httpAuth/app/rest/buildQueue",
-            postdata=bytes(build_id_xml, 'utf-8'),
+            postdata=build_id_xml,
             datatype="xml",
             user=user,
             password=password,
@@ -437,11 +564,12 @@ def trigger_build_with_same_revision(orig_build=None,
                                      teamcity_url=None,
                                      tcSessionId=None,
                                      comment=None,
-                                     build_props={},
+                                     build_props=None,
                                      build_type_id=None,
                                      only_if_finished=True,
                                      total_attempts=120,
-                                     sleep=30):
+                                     sleep=30,
+                                     long_poll=60):
     """
     Input:
         orig_build  : original build which needs to re-triggered
@@ -452,22 +580,36 @@ def trigger_build_with_same_revision(orig_build=None,
         tcSessionId : Re-use same existing session
         comment     : Specify comment for teamcity UI
         build_props : Pass params to build
+        total_attempts: Maximum number of polls of a running build; with
+                      sleep > 0 it also bounds the time spent waiting for the
+                      build to total_attempts * sleep seconds, independent of
+                      how long the server holds each long-poll. With sleep=0
+                      the polls are made back to back without long-polling
+        sleep       : Minimum seconds between two polls of a running build
+        long_poll   : Seconds the server may hold a poll until the state of
+                      the build changes
     Return:
         weburl of the build triggered
     """
+    build_props = {} if build_props is None else build_props
     if orig_build:
         # Find BuildType ID, Change ID and branch of original build
         if not only_if_finished:
             total_attempts = 1
         current_attempt = 0
+        deadline = time.monotonic() + total_attempts * sleep if sleep > 0 else None
         while True:
+            poll_started = time.monotonic()
+            # Never let a long-poll run past the overall waiting time
+            poll_wait = min(long_poll, int(deadline - poll_started)) if only_if_finished and deadline else 0
             output, tcSessionId = get_build_details(user=user,
                                                     password=password,
                                                     teamcity_url=teamcity_url,
                                                     project_id=orig_build,
                                                     isrunning=True,
                                                     debugout=verbose,
-                                                    tcSessionId=tcSessionId)
+                                                    tcSessionId=tcSessionId,
+                                                    long_poll=max(0, poll_wait))
             if output:
                 if not build_type_id:
                     build_type_id = output.get('buildTypeId')
@@ -479,13 +621,16 @@ def trigger_build_with_same_revision(orig_build=None,
                 print("ERROR: Original build ID is invalid")
                 return False, tcSessionId
             current_attempt += 1
-            if state == "running" and current_attempt < total_attempts:
-                time.sleep(sleep)
+            if state == "running" and current_attempt < total_attempts and \
+                    (deadline is None or time.monotonic() < deadline):
+                # A long-poll already waited on the server; only sleep what is left
+                # of the interval in case the server answered right away
+                time.sleep(max(0, sleep - (time.monotonic() - poll_started)))
             else:
                 break
         if only_if_finished and state == "running":
             print("ERROR: Original build still running, after {} attempts. "
-                  "Exit without trigger.".format(total_attempts))
+                  "Exit without trigger.".format(current_attempt))
             return False, tcSessionId
     elif build_type_id:
         change_id = ""
@@ -529,10 +674,7 @@ def main():
         }
     else:
         build_props = {}
-    for kv in args.other_param.split(";"):
-        key = kv.split("=")[0]
-        val = kv.split("=")[1]
-        build_props[key] = val
+    build_props.update(kv.split("=", 1) for kv in args.other_param.split(";") if "=" in kv)
 
     if args.validation:
         if args.build_type_id != 'SsgCiCtrl_ReviewBuildsTestAkshayRerun':